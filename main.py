@@ -1,120 +1,980 @@
 import argparse
+import json
 import logging
+import os
 import subprocess
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 
+from tqdm import tqdm
+
 # Additional import for better error reporting
 from subprocess import CalledProcessError
 
+# PyAV lets us read stream info in-process; fall back to ffprobe without it
+try:
+    import av
+except ImportError:
+    av = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Function to check if a file is already in HEVC format
-def is_hevc(file_path):
+# File extensions treated as videos, in the cases they are matched in
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".MP4", ".MKV", ".AVI")
+
+# Transcodes are written here first, then moved over the final output
+TMP_SUFFIX = ".hevc.tmp.mp4"
+
+# Codec names which are already HEVC
+HEVC_CODECS = ("hevc", "h265", "h.265")
+
+# Tags which mark an HEVC track near the start of MP4 and Matroska files
+HEVC_TAGS = (b"hvc1", b"hev1", b"V_MPEGH/ISO/HEVC")
+SNIFF_EXTENSIONS = (".mp4", ".mkv")
+SNIFF_SIZE = 64 * 1024
+
+# Audio codecs which can be copied as-is into an MP4 when remuxing; "" is no audio
+REMUX_AUDIO_CODECS = ("aac", "ac3", "eac3", "mp3", "")
+
+# Only read the container header when probing; stream info is stored there
+PROBE_OPTIONS = {"probesize": "32", "analyzeduration": "0"}
+
+# Probing mostly waits on I/O, so use more threads than there are CPUs
+DEFAULT_PROBE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Limit resolution to 1080p
+MAX_WIDTH = 1920
+
+# ffmpeg options for every run: never read the terminal, and overwrite our
+# own temporary files if an earlier run left any behind
+FFMPEG_ARGS = ("ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y")
+
+# Audio options for when the source audio is copied or re-encoded
+AUDIO_COPY_ARGS = ("-c:a", "copy")
+AUDIO_ENCODE_ARGS = ("-c:a", "aac", "-b:a", "128k")
+
+# x265 rejects more frame threads than this
+X265_MAX_FRAME_THREADS = 16
+
+# AAC audio up to this bit rate is copied rather than re-encoded
+AUDIO_COPY_MAX_BITRATE = 160000
+
+# One x265 encode rarely keeps every core busy, so run a few side by side
+DEFAULT_JOBS = max(1, (os.cpu_count() or 1) // 4)
+
+# Probe results are kept between runs, keyed on path, mtime and size
+PROBE_CACHE_FILE = Path.home() / ".cache" / "hevc_transcode" / "probe.json"
+PROBE_CACHE_VERSION = 6
+_probe_cache = {}
+
+# Stream info read from a video file; codecs are lower-case, "" when unknown
+ProbeInfo = namedtuple(
+    "ProbeInfo",
+    ["video_codec", "video_width", "video_height", "audio_codec", "audio_bitrate"],
+)
+FAILED_PROBE = ProbeInfo("", None, None, "", None)
+
+# Function to load probe results saved by a previous run
+def load_probe_cache():
     """
-    Check if a video file is already encoded in HEVC format.
+    Load the probe cache from disk, if there is a usable one.
+
+    Returns:
+        None
+    """
+    try:
+        with open(PROBE_CACHE_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    if isinstance(data, dict) and data.get("version") == PROBE_CACHE_VERSION:
+        _probe_cache.update(data.get("entries", {}))
+
+# Function to save probe results for the next run
+def save_probe_cache(root=None):
+    """
+    Write the probe cache to disk, replacing the old file atomically.
+
+    Entries for files under the scanned directory which no longer exist are
+    dropped. Entries elsewhere are kept without checking, as they may be on
+    a drive which is not mounted at the moment.
+
+    Args:
+        root (Path, optional): The directory which was scanned; if None, no entries are dropped.
+
+    Returns:
+        None
+    """
+    # Probe threads may still be adding entries, so save a snapshot
+    entries = dict(_probe_cache)
+    if root is not None:
+        prefix = os.path.join(os.path.abspath(root), "")
+        entries = {
+            path_str: entry
+            for path_str, entry in entries.items()
+            if not path_str.startswith(prefix) or os.path.exists(path_str)
+        }
+    tmp_file = PROBE_CACHE_FILE.with_suffix(".json.tmp")
+    try:
+        PROBE_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": PROBE_CACHE_VERSION, "entries": entries}, f)
+        os.replace(tmp_file, PROBE_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Could not save probe cache: {e}")
+
+# Function to look up a file in the probe cache
+def _lookup_probe_cache(path_str, mtime_ns, size):
+    """
+    Look up a file's stream info in the probe cache.
+
+    Args:
+        path_str (str): The absolute path to the video file.
+        mtime_ns (int): The modification time of the file, in nanoseconds.
+        size (int): The size of the file, in bytes.
+
+    Returns:
+        ProbeInfo: The cached stream info, or None if there is none for this version of the file.
+    """
+    entry = _probe_cache.get(path_str)
+    if entry is not None and entry[:2] == [mtime_ns, size]:
+        return ProbeInfo(*entry[2:])
+    return None
+
+# Function to probe a file and remember the result
+def _probe_cached(path_str, mtime_ns, size):
+    """
+    Probe a file, and record its stream info in the probe cache.
+
+    Args:
+        path_str (str): The absolute path to the video file.
+        mtime_ns (int): The modification time of the file, in nanoseconds.
+        size (int): The size of the file, in bytes.
+
+    Returns:
+        ProbeInfo: The stream info, or FAILED_PROBE if it could not be read.
+    """
+    info = _probe_file(path_str)
+    # Failed probes are not saved, so they are retried on the next run
+    if info != FAILED_PROBE:
+        _probe_cache[path_str] = [mtime_ns, size, *info]
+    return info
+
+# Function to spot HEVC files from their first few bytes
+def sniff_hevc(file_path, extensions=SNIFF_EXTENSIONS):
+    """
+    Check for an HEVC track tag at the start of an MP4 or Matroska file.
+
+    This is much cheaper than a probe, but only conclusive when a tag is
+    found, e.g. MP4 files with the index at the end will not match.
 
     Args:
         file_path (Path): The path to the video file.
+        extensions (tuple[str], optional): The lower-case file extensions to sniff; others are never matched.
 
     Returns:
-        bool: True if the file is in HEVC format, False otherwise.
+        bool: True if an HEVC tag was found, False otherwise.
     """
+    if file_path.suffix.lower() not in extensions:
+        return False
+
     try:
-        codec_info = subprocess.check_output(
+        with open(file_path, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+    except OSError:
+        return False
+    return any(tag in head for tag in HEVC_TAGS)
+
+# Function to read the bit rate a Matroska muxer stored in a track's tags
+def _tagged_bitrate(tags):
+    """
+    Read a stream's bit rate from the BPS tag mkvmerge writes into Matroska files.
+
+    Matroska headers have no bit rate, so this is the only place to find one
+    without reading the stream itself.
+
+    Args:
+        tags (dict[str, str]): The stream's tags.
+
+    Returns:
+        int: The bit rate in bits per second, or None if it is not tagged.
+    """
+    for key in ("BPS", "BPS-eng"):
+        value = tags.get(key, "")
+        if value.isdigit():
+            return int(value)
+    return None
+
+# Function to find the codecs used in a file
+def probe_file(file_path, sniff_extensions=SNIFF_EXTENSIONS):
+    """
+    Find the codecs and video size of the first video and audio streams in a file.
+
+    Results are cached against the file's modification time and size, so
+    unchanged files are only probed once. Files not in the cache but with an
+    HEVC tag near the start are reported as HEVC without a probe, as they are
+    skipped anyway.
+
+    Args:
+        file_path (Path): The path to the video file.
+        sniff_extensions (tuple[str], optional): The lower-case file extensions to sniff for HEVC before probing.
+
+    Returns:
+        ProbeInfo: The stream info, or FAILED_PROBE if it could not be read.
+    """
+    try:
+        stat = file_path.stat()
+    except OSError as e:
+        # e.g. a broken symlink, or a file removed since the directory was listed
+        logger.error(f"Error checking file: {file_path}")
+        logger.error(e)
+        return FAILED_PROBE
+    # Key on the absolute path so runs from other directories share the cache
+    path_str = os.path.abspath(file_path)
+    info = _lookup_probe_cache(path_str, stat.st_mtime_ns, stat.st_size)
+    if info is not None:
+        return info
+
+    if sniff_hevc(file_path, sniff_extensions):
+        return ProbeInfo("hevc", None, None, "", None)
+
+    return _probe_cached(path_str, stat.st_mtime_ns, stat.st_size)
+
+# Function to read the codecs used in a file
+def _probe_file(file_path):
+    """
+    Read the codecs and video size of the first video and audio streams in a file.
+
+    Uses PyAV when it is installed, so no process is spawned per file, and
+    falls back to ffprobe otherwise.
+
+    Args:
+        file_path (str): The path to the video file.
+
+    Returns:
+        ProbeInfo: The stream info, or FAILED_PROBE if it could not be read.
+    """
+    if av is not None:
+        try:
+            with av.open(file_path, options=PROBE_OPTIONS) as container:
+                video = container.streams.video[0]
+                audio = container.streams.audio[0] if container.streams.audio else None
+                # Use codec names rather than decoder names (e.g. mp3, not
+                # mp3float), to match ffprobe
+                return ProbeInfo(
+                    video.codec_context.codec.canonical_name.lower(),
+                    video.codec_context.width or None,
+                    video.codec_context.height or None,
+                    audio.codec_context.codec.canonical_name.lower() if audio else "",
+                    (audio.bit_rate or _tagged_bitrate(audio.metadata)) if audio else None,
+                )
+        except (av.error.FFmpegError, IndexError) as e:
+            logger.error(f"Error checking file: {file_path}")
+            logger.error(e)
+            return FAILED_PROBE
+
+    try:
+        output = subprocess.check_output(
             [
                 "ffprobe",
                 "-v",
                 "error",
-                "-select_streams",
-                "v:0",
+                "-probesize",
+                PROBE_OPTIONS["probesize"],
+                "-analyzeduration",
+                PROBE_OPTIONS["analyzeduration"],
                 "-show_entries",
-                "stream=codec_name",
+                "stream=codec_type,codec_name,width,height,bit_rate:stream_tags",
                 "-of",
-                "csv=p=0",
-                str(file_path),
-            ]
+                "json",
+                file_path,
+            ],
+            stderr=subprocess.DEVNULL,
         )
-        # Use decode('utf-8') to handle bytes object and perform case-insensitive check
-        return "hevc" in codec_info.decode('utf-8').lower() or "h265" in codec_info.decode('utf-8').lower()
     except subprocess.CalledProcessError as e:
         logger.error(f"Error checking file: {file_path}")
         logger.error(e)
+        return FAILED_PROBE
+
+    # Use the first stream of each type, as ffmpeg does when transcoding
+    streams = {}
+    for stream in json.loads(output).get("streams", []):
+        streams.setdefault(stream.get("codec_type"), stream)
+    video = streams.get("video", {})
+    audio = streams.get("audio", {})
+    if not video:
+        logger.error(f"Error checking file: {file_path}")
+        logger.error("No video stream found")
+        return FAILED_PROBE
+
+    bit_rate = audio.get("bit_rate", "")
+    return ProbeInfo(
+        video.get("codec_name", "").lower(),
+        video.get("width") or None,
+        video.get("height") or None,
+        audio.get("codec_name", "").lower(),
+        int(bit_rate) if bit_rate.isdigit() else _tagged_bitrate(audio.get("tags", {})),
+    )
+
+# Function to name the MP4 a file is transcoded or remuxed to
+def _mp4_path(file_path):
+    """
+    Name the MP4 file a video is transcoded or remuxed to.
+
+    MP4 files are replaced in place, whatever the case of their extension.
+
+    Args:
+        file_path (Path): The path to the video file.
+
+    Returns:
+        Path: The path to the output MP4 file.
+    """
+    if file_path.suffix.lower() == ".mp4":
+        return file_path
+    return file_path.with_suffix(".mp4")
+
+# Function to decide what to do with a file
+def detect_action(file_path, probe):
+    """
+    Decide whether a file needs transcoding, only remuxing into an MP4, or nothing.
+
+    Files outside an MP4 are skipped when an MP4 of the same name already
+    exists, as it may be their own earlier output and is never overwritten.
+    HEVC video outside an MP4 can be remuxed when its audio can be copied
+    into an MP4 as well.
+
+    Args:
+        file_path (Path): The path to the video file.
+        probe (ProbeInfo): The file's stream info, as returned by probe_file.
+
+    Returns:
+        str: "transcode", "remux" or "skip".
+    """
+    output_file = _mp4_path(file_path)
+    in_mp4 = output_file == file_path
+    if not in_mp4 and output_file.exists():
+        return "skip"
+    if probe.video_codec not in HEVC_CODECS:
+        return "transcode"
+    if not in_mp4 and probe.audio_codec in REMUX_AUDIO_CODECS:
+        return "remux"
+    return "skip"
+
+# Function to find the video files under a directory
+def iter_videos(root, extensions=VIDEO_EXTENSIONS):
+    """
+    Find the video files under a directory, without following symlinked directories.
+
+    Temporary files left by an interrupted transcode are skipped.
+
+    Args:
+        root (Path): The directory to search.
+        extensions (tuple[str], optional): The file extensions to match, case-sensitively.
+
+    Yields:
+        Path: The path to each video file.
+    """
+    stack = [str(root)]
+    while stack:
+        # List each directory in full before yielding from it, so files
+        # written next to their inputs during a run are never picked up
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning(f"Could not read directory: {e}")
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.endswith(TMP_SUFFIX):
+                continue
+            elif entry.name.endswith(extensions):
+                yield Path(entry.path)
+
+# Function to run a function over an iterable in a pool, a few items at a time
+def _bounded_map(executor, fn, items, window):
+    """
+    Run a function over an iterable in an executor, like Executor.map, but only
+    take items from the iterable as earlier calls finish.
+
+    Args:
+        executor (Executor): The executor to run the calls in.
+        fn (callable): The function to call with each item.
+        items (iterable): The items to pass to fn; may be a generator.
+        window (int): The most calls to have submitted at once.
+
+    Yields:
+        tuple: Each item and the result of fn(item), in the order of items.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+# Function to find the codecs of many files at once
+def scan_codecs(
+    paths, total=None, workers=DEFAULT_PROBE_WORKERS, sniff_extensions=SNIFF_EXTENSIONS
+):
+    """
+    Find the codecs of each file, probing several files at once.
+
+    Paths are taken lazily, so memory use does not grow with the number of files.
+
+    Args:
+        paths (iterable[Path]): The paths to the video files.
+        total (int, optional): The number of paths, for the progress bar.
+        workers (int, optional): The number of files to probe at the same time.
+        sniff_extensions (tuple[str], optional): The lower-case file extensions to sniff for HEVC before probing.
+
+    Yields:
+        tuple[Path, ProbeInfo]: Each path and its stream info, as returned by probe_file.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from tqdm(
+            _bounded_map(
+                executor,
+                partial(probe_file, sniff_extensions=sniff_extensions),
+                paths,
+                workers * 2,
+            ),
+            total=total,
+            desc="Checking",
+            unit="file",
+            # Cached and sniffed files take microseconds, so redraw sparingly
+            mininterval=0.25,
+            miniters=max(1, (total or 0) // 200),
+        )
+
+# Function to check if a file is already in HEVC format
+def is_hevc(file_path):
+    """
+    Check if a video file is already encoded in HEVC format.
+
+    Args:
+        file_path (Path): The path to the video file.
+
+    Returns:
+        bool: True if the file is in HEVC format, False otherwise.
+    """
+    return probe_file(file_path).video_codec in HEVC_CODECS
+
+# HEVC encoders which can be chosen with --encoder
+ENCODERS = ("libx265", "libsvthevc", "hevc_nvenc", "hevc_qsv", "hevc_vaapi")
+
+# Function to list the encoders ffmpeg was built with
+@lru_cache(maxsize=None)
+def available_encoders():
+    """
+    List the encoders supported by the installed ffmpeg.
+
+    Returns:
+        frozenset[str]: The encoder names, or an empty set if ffmpeg could not be run.
+    """
+    try:
+        output = subprocess.check_output(
+            ["ffmpeg", "-hide_banner", "-encoders"], stderr=subprocess.DEVNULL
+        )
+    except (OSError, CalledProcessError) as e:
+        logger.error(f"Error listing ffmpeg encoders: {e}")
+        return frozenset()
+
+    # Encoder lines look like " V....D libx265    libx265 H.265 / HEVC"
+    encoders = set()
+    for line in output.decode("utf-8").splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and len(fields[0]) == 6 and fields[0][0] in "VAS":
+            encoders.add(fields[1])
+    return frozenset(encoders)
+
+# Function to build the parts of the ffmpeg command line shared by every file
+@lru_cache(maxsize=None)
+def _encoder_args(encoder, threads=None):
+    """
+    Build the parts of the ffmpeg arguments which depend only on the encoder settings.
+
+    These are the same for every file in a run, so they are built once and reused.
+
+    Args:
+        encoder (str): The HEVC encoder to use, one of ENCODERS.
+        threads (int, optional): The number of threads ffmpeg may use (default: let ffmpeg decide).
+
+    Returns:
+        tuple: The input options, the scale filter template taking a {size},
+            the filter to use when not scaling (or None), and the video output options.
+    """
+    if encoder == "hevc_nvenc":
+        # Decode, scale and encode on the GPU so frames stay in video memory
+        input_args = ("-hwaccel", "cuda", "-hwaccel_output_format", "cuda")
+        scale_filter = "scale_cuda={size}:format=yuv420p"
+        unscaled_filter = "scale_cuda=format=yuv420p"
+        video_args = [
+            "-c:v",
+            "hevc_nvenc",
+            "-preset",
+            "p5",
+            "-tune",
+            "hq",
+            "-rc",
+            "vbr",
+            "-cq",
+            "23",
+            "-b:v",
+            "0",
+            "-profile:v",
+            "main",
+        ]
+    elif encoder == "hevc_qsv":
+        input_args = ()
+        scale_filter = "scale={size}:flags=lanczos+accurate_rnd"
+        unscaled_filter = None
+        video_args = [
+            "-pix_fmt",
+            "nv12",  # QSV only takes NV12 input for 8-bit HEVC
+            "-c:v",
+            "hevc_qsv",
+            "-preset",
+            "medium",
+            "-global_quality",
+            "23",
+            "-profile:v",
+            "main",
+        ]
+    elif encoder == "libsvthevc":
+        # SVT-HEVC spreads work over many cores better than x265
+        input_args = ()
+        scale_filter = "scale={size}:flags=lanczos+accurate_rnd"
+        unscaled_filter = None
+        video_args = [
+            "-pix_fmt",
+            "yuv420p",
+            "-c:v",
+            "libsvthevc",
+            "-preset",
+            "7",
+            "-rc",
+            "0",  # Constant QP
+            "-qp",
+            "28",
+            "-profile:v",
+            "main",
+        ]
+    elif encoder == "hevc_vaapi":
+        input_args = ("-vaapi_device", "/dev/dri/renderD128")
+        scale_filter = "format=nv12|vaapi,hwupload,scale_vaapi={size}"
+        unscaled_filter = "format=nv12|vaapi,hwupload"
+        video_args = [
+            "-c:v",
+            "hevc_vaapi",
+            "-qp",
+            "23",
+            "-profile:v",
+            "main",
+        ]
+    else:
+        input_args = ()
+        scale_filter = "scale={size}:flags=lanczos+accurate_rnd"
+        unscaled_filter = None
+        video_args = [
+            "-c:v",
+            "libx265",
+            "-crf",
+            "23",
+            "-preset",
+            "medium",
+            "-pix_fmt",
+            "yuv420p",  # Optimal pixel format for compatibility
+            "-profile:v",
+            "main",  # Main profile for wider compatibility
+            "-level",
+            "4.0",  # Level 4.0 for compatibility with Google TV
+        ]
+        if threads:
+            # Size x265's own thread pool to match, rather than one pool per NUMA node
+            video_args += [
+                "-x265-params",
+                f"pools={threads}:frame-threads={min(threads, X265_MAX_FRAME_THREADS)}",
+            ]
+
+    video_args += [
+        "-movflags",
+        "+faststart",  # Enable faststart for streaming
+        *(["-threads", str(threads)] if threads else []),
+    ]
+    return input_args, scale_filter, unscaled_filter, tuple(video_args)
+
+# Function to build the ffmpeg command line for a transcode
+def build_ffmpeg_args(
+    encoder, input_path, outputs, threads=None, copy_audio=False, source_size=None
+):
+    """
+    Build the ffmpeg arguments to transcode a file with the given encoder.
+
+    The input is decoded once and encoded separately for each output. An
+    output limited only by width keeps the source's aspect ratio, and is not
+    run through a scaler if the source already fits and has an even size, as
+    yuv420p needs. Either side of the source may end up as its width, as
+    ffmpeg applies any rotation before scaling, so both are checked. An
+    output limited by width and height is fitted inside that box instead.
+
+    Args:
+        encoder (str): The HEVC encoder to use, one of ENCODERS.
+        input_path (str): The path to the input video file.
+        outputs (list[tuple[str, int, int]]): Each path to write an HEVC-encoded file to, and the width and height to limit it to; the height may be None.
+        threads (int, optional): The number of threads ffmpeg may use (default: let ffmpeg decide).
+        copy_audio (bool, optional): If True, copy the audio stream instead of re-encoding it to AAC.
+        source_size (tuple[int, int], optional): The width and height of the input video, as stored, if known.
+
+    Returns:
+        list[str]: The ffmpeg command line.
+    """
+    input_args, scale_filter, unscaled_filter, video_args = _encoder_args(encoder, threads)
+    audio_args = AUDIO_COPY_ARGS if copy_audio else AUDIO_ENCODE_ARGS
+
+    args = [*FFMPEG_ARGS, *input_args, "-i", input_path]
+    for output_path, max_width, max_height in outputs:
+        if max_height is not None:
+            # Fit inside the box without upscaling, keeping sizes even for yuv420p
+            video_filter = scale_filter.format(
+                size=f"w=min(iw\\,{max_width}):h=min(ih\\,{max_height})"
+                ":force_original_aspect_ratio=decrease:force_divisible_by=2"
+            )
+        elif source_size is not None and all(
+            side <= max_width and side % 2 == 0 for side in source_size
+        ):
+            video_filter = unscaled_filter
+        else:
+            # Never upscale, and keep the height even for yuv420p
+            video_filter = scale_filter.format(size=f"w=min(iw\\,{max_width}):h=-2")
+        if video_filter:
+            args += ["-vf", video_filter]
+        args += [*video_args, *audio_args, output_path]
+    return args
+
+# Function to stop a file's pages taking up the page cache
+def _drop_page_cache(file_path):
+    """
+    Ask the kernel to drop a file's cached pages, where posix_fadvise is supported.
+
+    Args:
+        file_path (Path): The path to the file.
+
+    Returns:
+        None
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    try:
+        with open(file_path, "rb") as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        logger.debug(f"Could not drop {file_path} from the page cache: {e}")
+
+# Function to name the temporary file an output is written to
+def _tmp_path(input_file, output_file):
+    """
+    Name the temporary file to write an output to before moving it into place.
+
+    The name includes the input's extension, so inputs sharing an output path
+    (e.g. video.mkv and video.mp4) never write to the same temporary file.
+
+    Args:
+        input_file (Path): The path to the input video file.
+        output_file (Path): The path the output will be moved to.
+
+    Returns:
+        Path: The path to the temporary file, next to the output.
+    """
+    return output_file.with_name(f"{output_file.stem}{input_file.suffix}{TMP_SUFFIX}")
+
+# Function to check whether writing an output would overwrite another file
+def _output_taken(input_file, output_file):
+    """
+    Check whether an output path is already used by a file other than the input.
+
+    Args:
+        input_file (Path): The path to the input video file.
+        output_file (Path): The path the output would be written to.
+
+    Returns:
+        bool: True if writing the output would overwrite some other file, False otherwise.
+    """
+    if not output_file.exists():
         return False
+    try:
+        return not os.path.samefile(input_file, output_file)
+    except OSError:
+        return True
 
-# Function to transcode a video file to HEVC
-def transcode_to_hevc(input_file):
+# Function to move a finished output into place, unless that would overwrite another file
+def _move_into_place(input_file, tmp_file, output_file):
     """
-    Transcode a video file to HEVC format.
+    Move a finished temporary file over its output path.
+
+    The input itself may be replaced, but any other existing file is left
+    alone and the temporary file is removed instead.
+
+    Args:
+        input_file (Path): The path to the input video file.
+        tmp_file (Path): The path to the finished temporary file.
+        output_file (Path): The path to move it to.
+
+    Returns:
+        bool: True if the file was moved into place, False otherwise.
+    """
+    if _output_taken(input_file, output_file):
+        logger.warning(f"Not overwriting existing file: {output_file}")
+        tmp_file.unlink(missing_ok=True)
+        return False
+    os.replace(tmp_file, output_file)
+    return True
+
+# Function to run one ffmpeg process writing one or more HEVC files
+def _transcode(input_file, outputs, threads=None, encoder="libx265", probe=None):
+    """
+    Transcode a video file to one or more HEVC files with a single ffmpeg process.
+
+    Each output is written to a temporary file and only moved into place once
+    ffmpeg succeeds, so an output may safely replace its input. Nothing is
+    done if an output would overwrite any other existing file.
 
     Args:
         input_file (Path): The path to the input video file.
+        outputs (list[tuple[Path, int, int]]): Each path to write an HEVC-encoded file to, and the width and height to limit it to; the height may be None.
+        threads (int, optional): The number of threads ffmpeg may use (default: let ffmpeg decide).
+        encoder (str, optional): The HEVC encoder to use, one of ENCODERS.
+        probe (ProbeInfo, optional): The file's stream info, used to skip needless scaling and audio re-encoding.
 
     Returns:
-        Path: The path to the output HEVC-encoded file.
+        bool: True if the transcode succeeded, False otherwise.
     """
-    output_file = input_file.with_suffix(".mp4")
-    input_path = str(input_file)
-    output_path = str(output_file)
+    copy_audio = (
+        probe is not None
+        and probe.audio_codec == "aac"
+        and probe.audio_bitrate is not None
+        and probe.audio_bitrate <= AUDIO_COPY_MAX_BITRATE
+    )
+    source_size = None
+    if probe is not None and probe.video_width and probe.video_height:
+        source_size = (probe.video_width, probe.video_height)
+    tmp_files = [_tmp_path(input_file, output_file) for output_file, _, _ in outputs]
+    output_args = [
+        (str(tmp_file), max_width, max_height)
+        for tmp_file, (_, max_width, max_height) in zip(tmp_files, outputs)
+    ]
+
+    for output_file, _, _ in outputs:
+        if _output_taken(input_file, output_file):
+            logger.warning(f"Not transcoding {input_file}: {output_file} already exists.")
+            return False
 
     try:
         subprocess.run(
-            [
-                "ffmpeg",
-                "-i",
-                input_path,
-                "-c:v",
-                "libx265",
-                "-crf",
-                "23",
-                "-preset",
-                "medium",
-                "-vf",
-                "scale=min(iw\\,1920):-2",  # Limit resolution to 1080p
-                "-c:a",
-                "aac",
-                "-b:a",
-                "128k",
-                "-movflags",
-                "+faststart",  # Enable faststart for streaming
-                "-pix_fmt",
-                "yuv420p",  # Optimal pixel format for compatibility
-                "-profile:v",
-                "main",  # Main profile for wider compatibility
-                "-level",
-                "4.0",  # Level 4.0 for compatibility with Google TV
-                output_path,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            build_ffmpeg_args(
+                encoder,
+                str(input_file),
+                output_args,
+                threads,
+                copy_audio,
+                source_size,
+            ),
+            # Nothing reads ffmpeg's output, so don't buffer it in pipes
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
         )
     except CalledProcessError as e:
         logger.error(f"Error during transcoding: {e}")
+        for tmp_file in tmp_files:
+            tmp_file.unlink(missing_ok=True)
+        return False
+    finally:
+        # The input is read once, so don't let it crowd other jobs out of the page cache
+        _drop_page_cache(input_file)
+
+    # Check again, as another file may have appeared during a long transcode
+    moved = [
+        _move_into_place(input_file, tmp_file, output_file)
+        for tmp_file, (output_file, _, _) in zip(tmp_files, outputs)
+    ]
+    return all(moved)
+
+# Function to transcode a video file to HEVC
+def transcode_to_hevc(input_file, threads=None, encoder="libx265", probe=None):
+    """
+    Transcode a video file to HEVC format.
 
+    Args:
+        input_file (Path): The path to the input video file.
+        threads (int, optional): The number of threads ffmpeg may use (default: let ffmpeg decide).
+        encoder (str, optional): The HEVC encoder to use, one of ENCODERS.
+        probe (ProbeInfo, optional): The file's stream info, used to skip needless scaling and audio re-encoding.
+
+    Returns:
+        Path: The path to the output HEVC-encoded file, or None if transcoding failed.
+    """
+    output_file = _mp4_path(input_file)
+    if not _transcode(input_file, [(output_file, MAX_WIDTH, None)], threads, encoder, probe):
+        return None
+    return output_file
+
+# Function to transcode a video file to several HEVC resolutions
+def transcode_ladder(input_file, rungs, threads=None, encoder="libx265", probe=None):
+    """
+    Transcode a video file to HEVC at several resolutions, decoding it only once.
+
+    Each rung is fitted inside its width and height, keeping the aspect ratio
+    and never upscaling, and named after its height, e.g. video_720p.mp4 for
+    (1280, 720).
+
+    Args:
+        input_file (Path): The path to the input video file.
+        rungs (list[tuple[int, int]]): The width and height of each resolution.
+        threads (int, optional): The number of threads ffmpeg may use (default: let ffmpeg decide).
+        encoder (str, optional): The HEVC encoder to use, one of ENCODERS.
+        probe (ProbeInfo, optional): The file's stream info, used to skip needless scaling and audio re-encoding.
+
+    Returns:
+        list[Path]: The paths to the output HEVC-encoded files, or an empty list if transcoding failed.
+    """
+    outputs = [
+        (input_file.with_name(f"{input_file.stem}_{height}p.mp4"), width, height)
+        for width, height in rungs
+    ]
+    if not _transcode(input_file, outputs, threads, encoder, probe):
+        return []
+    return [output_file for output_file, _, _ in outputs]
+
+# Function to copy a file's streams into an MP4 in-process
+def _remux_with_av(input_path, output_path):
+    """
+    Copy the first video and audio streams of a file into an MP4 with PyAV.
+
+    Args:
+        input_path (str): The path to the input video file.
+        output_path (str): The path to write the MP4 file to.
+
+    Returns:
+        None
+    """
+    with av.open(input_path) as src, av.open(
+        output_path, "w", format="mp4", options={"movflags": "+faststart"}
+    ) as dst:
+        streams = src.streams.video[:1] + src.streams.audio[:1]
+        out_streams = {s.index: dst.add_stream_from_template(s) for s in streams}
+        for packet in src.demux(streams):
+            # Skip the empty packets demux yields at the end of each stream.
+            # Real Matroska packets may lack a dts, so it cannot be used here.
+            if packet.size == 0:
+                continue
+            packet.stream = out_streams[packet.stream.index]
+            dst.mux(packet)
+
+# Function to copy a file's streams into an MP4 without re-encoding them
+def remux_to_mp4(input_file):
+    """
+    Remux the first video and audio streams of a file into an MP4, copying them as-is.
+
+    Uses PyAV when it is installed, so no ffmpeg process is needed, and falls
+    back to ffmpeg otherwise. The output is written to a temporary file first,
+    as for transcodes, and an existing MP4 is never overwritten.
+
+    Args:
+        input_file (Path): The path to the input video file.
+
+    Returns:
+        Path: The path to the output MP4 file, or None if remuxing failed.
+    """
+    output_file = _mp4_path(input_file)
+    tmp_file = _tmp_path(input_file, output_file)
+    if _output_taken(input_file, output_file):
+        logger.warning(f"Not remuxing {input_file}: {output_file} already exists.")
+        return None
+
+    error = None
+    if av is not None:
+        try:
+            _remux_with_av(str(input_file), str(tmp_file))
+        except (av.error.FFmpegError, OSError) as e:
+            error = e
+    else:
+        try:
+            subprocess.run(
+                [
+                    *FFMPEG_ARGS,
+                    "-i",
+                    str(input_file),
+                    "-map",
+                    "0:v:0",
+                    "-map",
+                    "0:a:0?",
+                    "-c",
+                    "copy",
+                    "-movflags",
+                    "+faststart",
+                    str(tmp_file),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+        except CalledProcessError as e:
+            error = e
+
+    if error is not None:
+        logger.error(f"Error during remuxing: {error}")
+        tmp_file.unlink(missing_ok=True)
+        return None
+
+    if not _move_into_place(input_file, tmp_file, output_file):
+        return None
     return output_file
 
 # Main function
-def main(target_directory, dry_run=False):
+def main(
+    target_directory,
+    dry_run=False,
+    probe_workers=DEFAULT_PROBE_WORKERS,
+    jobs=DEFAULT_JOBS,
+    encoder="libx265",
+    remux=False,
+):
     """
     Main function to transcode video files in a target directory to HEVC format.
 
     Args:
         target_directory (str): The target directory to search for video files.
         dry_run (bool, optional): If True, only preview the number of files to be transcoded (no actual transcoding).
+        probe_workers (int, optional): The number of files to check for HEVC at the same time.
+        jobs (int, optional): The number of files to transcode at the same time.
+        encoder (str, optional): The HEVC encoder to use, one of ENCODERS.
+        remux (bool, optional): If True, also copy HEVC files in other containers into MP4s.
 
     Returns:
         None
     """
     target_directory = Path(target_directory)
-    video_extensions = (".mp4", ".mkv", ".avi")
-    video_files = [
-        file
-        for file in target_directory.glob("**/*.*")
-        if file.suffix.lower() in video_extensions
-    ]
-    total_files = len(video_files)
-    transcode_count = 0
+    # Count first so progress can be shown without holding every path in memory
+    total_files = sum(1 for _ in iter_videos(target_directory))
+    # Count finished transcodes and remuxes separately
+    counts = Counter()
+
+    if total_files == 0:
+        logger.info("No video files found.")
+        return
 
     # Use a try-except block to handle KeyboardInterrupt
     try:
@@ -122,25 +982,94 @@ def main(target_directory, dry_run=False):
             logger.info(f"Total files found: {total_files}")
             logger.info("Calculating files to be transcoded...")
 
-            for video_file in video_files:
-                if not is_hevc(video_file):
-                    transcode_count += 1
+        load_probe_cache()
+        # Remuxing needs the audio codec, which sniffing doesn't find
+        codecs = scan_codecs(
+            iter_videos(target_directory),
+            total_files,
+            probe_workers,
+            (".mp4",) if remux else SNIFF_EXTENSIONS,
+        )
+        actions = ((f, info, detect_action(f, info)) for f, info in codecs)
+        to_transcode = (
+            item
+            for item in actions
+            if item[2] == "transcode" or (remux and item[2] == "remux")
+        )
 
+        if dry_run:
+            counts.update(action for _, _, action in to_transcode)
+            percent = counts["transcode"] / total_files * 100
             logger.info(
-                f"{transcode_count}/{total_files} files would be transcoded ({(transcode_count / total_files) * 100:.2f}%)."
+                f"{counts['transcode']}/{total_files} files would be transcoded ({percent:.2f}%)."
             )
+            if remux:
+                percent = counts["remux"] / total_files * 100
+                logger.info(
+                    f"{counts['remux']}/{total_files} files would be remuxed ({percent:.2f}%)."
+                )
             return
 
-        for video_file in video_files:
-            if not is_hevc(video_file):
-                transcode_to_hevc(video_file)
-                transcode_count += 1
+        if encoder != "libx265" and encoder not in available_encoders():
+            logger.warning(f"ffmpeg does not support {encoder}, using libx265 instead.")
+            encoder = "libx265"
+
+        # Share the CPUs between the ffmpeg processes running at once
+        threads = max(2, (os.cpu_count() or 1) // jobs)
+
+        def transcode(item):
+            video_file, info, action = item
+            if action == "remux":
+                return remux_to_mp4(video_file)
+            return transcode_to_hevc(video_file, threads, encoder, info)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            try:
+                for (_, _, action), output_file in tqdm(
+                    _bounded_map(
+                        executor,
+                        transcode,
+                        to_transcode,
+                        jobs * 2,
+                    ),
+                    desc="Transcoding",
+                    unit="file",
+                ):
+                    if output_file is not None:
+                        counts[action] += 1
+            except KeyboardInterrupt:
+                # Don't start the queued transcodes on the way out
+                executor.shutdown(cancel_futures=True)
+                raise
 
         logger.info(
-            f"Transcoding complete. {transcode_count}/{total_files} files transcoded."
+            f"Transcoding complete. {counts['transcode']}/{total_files} files transcoded."
         )
+        if remux:
+            logger.info(f"{counts['remux']}/{total_files} files remuxed.")
     except KeyboardInterrupt:
         logger.warning("Transcoding interrupted by user.")
+    finally:
+        save_probe_cache(target_directory)
+
+# Function to parse a command line count which must be at least one
+def positive_int(value):
+    """
+    Parse a command line argument as an integer of at least 1.
+
+    Args:
+        value (str): The argument as given on the command line.
+
+    Returns:
+        int: The parsed value.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Batch transcode video files to HEVC.")
@@ -152,6 +1081,36 @@ if __name__ == "__main__":
         action="store_true",
         help="Preview the number of files to be transcoded (no actual transcoding)",
     )
+    parser.add_argument(
+        "--probe-workers",
+        type=positive_int,
+        default=DEFAULT_PROBE_WORKERS,
+        help=f"Number of files to check for HEVC at the same time (default: {DEFAULT_PROBE_WORKERS})",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help=f"Number of files to transcode at the same time (default: {DEFAULT_JOBS})",
+    )
+    parser.add_argument(
+        "--encoder",
+        choices=ENCODERS,
+        default="libx265",
+        help="HEVC encoder to use; falls back to libx265 if ffmpeg lacks it (default: libx265)",
+    )
+    parser.add_argument(
+        "--remux",
+        action="store_true",
+        help="Also copy HEVC files in other containers into MP4s, without re-encoding",
+    )
     args = parser.parse_args()
 
-    main(args.target_directory, args.dry_run)
+    main(
+        args.target_directory,
+        args.dry_run,
+        args.probe_workers,
+        args.jobs,
+        args.encoder,
+        args.remux,
+    )
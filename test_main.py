@@ -0,0 +1,221 @@
+from fractions import Fraction
+
+import pytest
+
+import main
+
+av = pytest.importorskip("av")
+
+
+def run_video_filter(video_filter, width, height):
+    """Run one frame of the given size through a -vf filter and return the output size."""
+    name, args = video_filter.split("=", 1)
+    graph = av.filter.Graph()
+    src = graph.add_buffer(
+        width=width, height=height, format="yuv420p", time_base=Fraction(1, 25)
+    )
+    scale = graph.add(name, args)
+    sink = graph.add("buffersink")
+    src.link_to(scale)
+    scale.link_to(sink)
+    graph.configure()
+
+    frame = av.VideoFrame(width, height, "yuv420p")
+    frame.pts = 0
+    frame.time_base = Fraction(1, 25)
+    graph.push(frame)
+    output = graph.pull()
+    return output.width, output.height
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ((1920, 1080), (1280, 720)),
+        ((1080, 1920), (406, 720)),
+        ((1440, 1080), (960, 720)),
+        ((640, 360), (640, 360)),
+        ((3840, 1600), (1280, 534)),
+    ],
+)
+def test_ladder_rung_fits_inside_its_box(source, expected):
+    args = main.build_ffmpeg_args("libx265", "in.mkv", [("out.mp4", 1280, 720)])
+    video_filter = args[args.index("-vf") + 1]
+
+    assert run_video_filter(video_filter, *source) == expected
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ((1920, 803), (1920, 804)),
+        ((2560, 1440), (1920, 1080)),
+        ((1440, 2560), (1440, 2560)),
+        ((1280, 720), (1280, 720)),
+    ],
+)
+def test_scaled_output_is_even_and_never_upscaled(source, expected):
+    args = main.build_ffmpeg_args("libx265", "in.mkv", [("out.mp4", 1920, None)])
+    video_filter = args[args.index("-vf") + 1]
+
+    assert run_video_filter(video_filter, *source) == expected
+
+
+@pytest.mark.parametrize(
+    "source_size, scaled",
+    [
+        ((1920, 1080), False),
+        ((1080, 1920), False),
+        ((1920, 803), True),
+        ((1440, 2560), True),
+    ],
+)
+def test_scaler_is_skipped_only_for_even_sizes_that_fit(source_size, scaled):
+    args = main.build_ffmpeg_args(
+        "libx265", "in.mkv", [("out.mp4", 1920, None)], source_size=source_size
+    )
+
+    assert ("-vf" in args) == scaled
+
+
+def test_ladder_builds_one_output_per_rung(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "_transcode", lambda *args: calls.append(args) or True)
+    input_file = tmp_path / "video.mkv"
+
+    outputs = main.transcode_ladder(input_file, [(1920, 1080), (1280, 720)])
+
+    assert outputs == [tmp_path / "video_1080p.mp4", tmp_path / "video_720p.mp4"]
+    assert calls[0][1] == [
+        (tmp_path / "video_1080p.mp4", 1920, 1080),
+        (tmp_path / "video_720p.mp4", 1280, 720),
+    ]
+
+
+def test_inputs_sharing_an_output_use_different_temporary_files(tmp_path):
+    output_file = tmp_path / "video.mp4"
+    tmp_files = {
+        main._tmp_path(tmp_path / name, output_file)
+        for name in ("video.mkv", "video.mp4", "video.avi")
+    }
+
+    assert len(tmp_files) == 3
+    assert all(f.name.endswith(main.TMP_SUFFIX) for f in tmp_files)
+
+
+def test_existing_mp4_is_never_overwritten(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.subprocess, "run", lambda *args, **kwargs: pytest.fail("ran ffmpeg"))
+    input_file = tmp_path / "video.mkv"
+    input_file.write_bytes(b"mkv")
+    output_file = tmp_path / "video.mp4"
+    output_file.write_bytes(b"mp4")
+    probe = main.ProbeInfo("h264", 1280, 720, "aac", 128000)
+
+    assert main.detect_action(input_file, probe) == "skip"
+    assert main.transcode_to_hevc(input_file, probe=probe) is None
+    assert main.remux_to_mp4(input_file) is None
+    assert output_file.read_bytes() == b"mp4"
+
+
+def write_hevc_mkv(path, frames=30, audio_codec=None, audio_tags=None):
+    """Write a small libx265 Matroska file, with an audio stream if a codec is given."""
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx265", rate=25)
+        stream.width, stream.height, stream.pix_fmt = 64, 64, "yuv420p"
+        stream.options = {"x265-params": "log-level=none"}
+        if audio_codec is not None:
+            audio = container.add_stream(audio_codec, rate=44100, layout="stereo")
+            audio.metadata.update(audio_tags or {})
+            samples = audio.codec_context.frame_size or 1024
+            frame = av.AudioFrame(format=audio.format.name, layout="stereo", samples=samples)
+            for plane in frame.planes:
+                plane.update(bytes(plane.buffer_size))
+            frame.sample_rate = 44100
+            container.mux(audio.encode(frame))
+            container.mux(audio.encode())
+        for i in range(frames):
+            frame = av.VideoFrame(64, 64, "yuv420p")
+            for plane in frame.planes:
+                plane.update(bytes([i * 8]) * plane.buffer_size)
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode())
+
+
+def count_frames(path):
+    """Decode the first video stream of a file and return its number of frames."""
+    with av.open(str(path)) as container:
+        return sum(1 for _ in container.decode(video=0))
+
+
+def test_remux_keeps_every_frame(tmp_path):
+    input_file = tmp_path / "video.mkv"
+    write_hevc_mkv(input_file)
+
+    output_file = main.remux_to_mp4(input_file)
+
+    assert output_file == tmp_path / "video.mp4"
+    assert count_frames(output_file) == count_frames(input_file) == 30
+
+
+def test_missing_file_fails_to_probe(tmp_path):
+    link = tmp_path / "video.mkv"
+    link.symlink_to(tmp_path / "missing.mkv")
+
+    assert main.probe_file(link) == main.FAILED_PROBE
+
+
+def test_probe_reports_codec_names_not_decoder_names(tmp_path):
+    input_file = tmp_path / "video.mkv"
+    write_hevc_mkv(input_file, audio_codec="libmp3lame")
+
+    info = main._probe_file(str(input_file))
+
+    assert (info.video_codec, info.audio_codec) == ("hevc", "mp3")
+    assert main.detect_action(input_file, info) == "remux"
+
+
+def test_upper_case_mp4_is_replaced_in_place(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "_transcode", lambda *args: calls.append(args) or True)
+    input_file = tmp_path / "video.MP4"
+    input_file.write_bytes(b"mp4")
+    probe = main.ProbeInfo("h264", 1280, 720, "aac", 128000)
+
+    assert main.detect_action(input_file, probe) == "transcode"
+    assert main.transcode_to_hevc(input_file, probe=probe) == input_file
+    assert calls[0][1] == [(input_file, main.MAX_WIDTH, None)]
+
+
+def test_saving_probe_cache_only_prunes_the_scanned_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PROBE_CACHE_FILE", tmp_path / "probe.json")
+    scanned = tmp_path / "scanned"
+    scanned.mkdir()
+    (scanned / "kept.mkv").write_bytes(b"mkv")
+    entry = [0, 3, "h264", 1280, 720, "aac", None]
+    monkeypatch.setattr(
+        main,
+        "_probe_cache",
+        {
+            str(scanned / "kept.mkv"): entry,
+            str(scanned / "removed.mkv"): entry,
+            str(tmp_path / "unmounted" / "other.mkv"): entry,
+        },
+    )
+
+    main.save_probe_cache(scanned)
+    main._probe_cache.clear()
+    main.load_probe_cache()
+
+    assert set(main._probe_cache) == {
+        str(scanned / "kept.mkv"),
+        str(tmp_path / "unmounted" / "other.mkv"),
+    }
+
+
+def test_probe_reads_matroska_audio_bit_rate_from_tags(tmp_path):
+    input_file = tmp_path / "video.mkv"
+    write_hevc_mkv(input_file, audio_codec="aac", audio_tags={"BPS": "128000"})
+
+    info = main._probe_file(str(input_file))
+
+    assert (info.audio_codec, info.audio_bitrate) == ("aac", 128000)